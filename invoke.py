@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from functools import partial
+from functools import cached_property, partial
+import hashlib
 import json
 import os
 from pathlib import Path
+import queue
 import requests
+from requests.adapters import HTTPAdapter
 import shutil
 import subprocess
-from typing import Dict, Iterable, List, Optional
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 import appdirs
 import attr
@@ -18,9 +23,20 @@ import click
 import dateutil.parser
 from dateutil.tz import UTC
 from jinja2 import Environment, FileSystemLoader, StrictUndefined
+import numpy as np
 import pandas as pd
 
-jinja = Environment(loader=FileSystemLoader("."), undefined=StrictUndefined)
+jinja = Environment(
+    loader=FileSystemLoader("."),
+    undefined=StrictUndefined,
+    auto_reload=False,
+    cache_size=-1,
+)
+
+converter = cattr.GenConverter()
+
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
 
 
 class Cache:
@@ -28,10 +44,18 @@ class Cache:
     RESULT_CACHE_PATH = "results"
     EXPERIMENT_BUCKET_URL = "gs://mozanalysis/statistics"
     EXPERIMENTS_FILENAME = "experiments.json"
+    ETAGS_FILENAME = "experiments.etags.json"
+    HASHES_FILENAME = "hashes.json"
 
     def __init__(self, path=None):
         self.path = Path(path or appdirs.user_cache_dir("partybal", "Mozilla"))
 
+    def __getstate__(self):
+        # Cache is sent to every render worker; they don't need the experiments.
+        state = dict(self.__dict__)
+        state.pop("experiments", None)
+        return state
+
     def assert_exists(self, path: Optional[Path] = None):
         (path or self.path).mkdir(parents=True, exist_ok=True)
 
@@ -50,15 +74,31 @@ class Cache:
         except Exception:
             return datetime.min.replace(tzinfo=UTC)
 
+    @staticmethod
+    def rsync_command() -> List[str]:
+        # `gcloud storage` transfers much faster than gsutil,
+        # but older Cloud SDK releases don't ship it.
+        if shutil.which("gcloud"):
+            probe = subprocess.run(
+                ["gcloud", "storage", "rsync", "--help"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            if probe.returncode == 0:
+                return [
+                    "gcloud",
+                    "storage",
+                    "rsync",
+                    "--recursive",
+                    "--delete-unmatched-destination-objects",
+                ]
+        return ["gsutil", "-m", "rsync", "-d", "-r"]
+
     def sync(self, remote_bucket_url=None) -> None:
         self.assert_exists(self.path / self.RESULT_CACHE_PATH)
         result = subprocess.run(
-            [
-                "gsutil",
-                "-m",
-                "rsync",
-                "-d",
-                "-r",
+            self.rsync_command()
+            + [
                 remote_bucket_url or self.EXPERIMENT_BUCKET_URL,
                 str(self.path / self.RESULT_CACHE_PATH),
             ],
@@ -69,39 +109,88 @@ class Cache:
         if result.returncode:
             raise Exception(result.stdout)
 
-        experiments = cattr.unstructure(ExperimentCollection.from_experimenter())
-        (self.path / self.EXPERIMENTS_FILENAME).write_text(json.dumps(experiments))
+        experiments_path = self.path / self.EXPERIMENTS_FILENAME
+        etags_path = self.path / self.ETAGS_FILENAME
+        etags = {}
+        if experiments_path.exists() and etags_path.exists():
+            etags = json.loads(etags_path.read_text())
+        collection, etags = ExperimentCollection.from_experimenter(etags)
+        if collection is None:
+            return
+        self.__dict__.pop("experiments", None)
+        experiments = converter.unstructure(collection)
+        experiments_path.write_text(json.dumps(experiments))
+        etags_path.write_text(json.dumps(etags))
 
     def clean(self) -> None:
         shutil.rmtree(self.path)
 
-    def new_since_last_run(self, last_run: Optional[datetime] = None) -> List[Path]:
-        last_run = last_run or self.last_run
-        results = []
-        for p in (self.path / self.RESULT_CACHE_PATH).iterdir():
-            mtime = p.stat().st_mtime
-            if datetime.fromtimestamp(mtime, UTC) > last_run:
-                results.append(p)
-        return results
+    def new_since_last_run(self, last_run: Optional[datetime] = None) -> List[str]:
+        cutoff = (last_run or self.last_run).timestamp()
+        with os.scandir(self.path / self.RESULT_CACHE_PATH) as it:
+            return [e.name for e in it if e.stat().st_mtime > cutoff]
 
     @property
+    def result_hashes(self) -> Dict[str, list]:
+        try:
+            return json.loads((self.path / self.HASHES_FILENAME).read_text())
+        except Exception:
+            return {}
+
+    def save_result_hashes(self, hashes: Dict[str, list]) -> None:
+        self.assert_exists()
+        (self.path / self.HASHES_FILENAME).write_text(json.dumps(hashes))
+
+    def hash_results(
+        self, previous: Optional[Dict[str, list]] = None
+    ) -> Dict[str, list]:
+        # Maps result filenames to [st_mtime_ns, st_size, digest]. Files whose
+        # stat matches `previous` keep their old digest without being reread.
+        previous = previous or {}
+        hashes = {}
+        with os.scandir(self.path / self.RESULT_CACHE_PATH) as it:
+            for e in it:
+                if not e.is_file():
+                    continue
+                stat = e.stat()
+                old = previous.get(e.name)
+                if old and old[:2] == [stat.st_mtime_ns, stat.st_size]:
+                    hashes[e.name] = old
+                    continue
+                digest = hashlib.blake2b(
+                    Path(e.path).read_bytes(), digest_size=16
+                ).hexdigest()
+                hashes[e.name] = [stat.st_mtime_ns, stat.st_size, digest]
+        return hashes
+
+    @staticmethod
+    def changed_results(
+        previous: Dict[str, list], current: Dict[str, list]
+    ) -> Set[str]:
+        return {
+            name
+            for name, (*_, digest) in current.items()
+            if name not in previous or previous[name][-1] != digest
+        }
+
+    @cached_property
     def experiments(self) -> "ExperimentCollection":
         serialized = (self.path / self.EXPERIMENTS_FILENAME).read_text()
         deserialized = json.loads(serialized)
-        return cattr.structure(deserialized, ExperimentCollection)
+        return converter.structure(deserialized, ExperimentCollection)
 
 
 ## Experimenter API types
 
 
-@attr.s(auto_attribs=True)
+@attr.s(auto_attribs=True, slots=True)
 class Variant:
     slug: str
     description: str
     is_control: bool
 
 
-@attr.s(auto_attribs=True)
+@attr.s(auto_attribs=True, slots=True)
 class Experiment:
     name: str
     slug: str
@@ -115,10 +204,9 @@ class Experiment:
 
     @property
     def control_branch_slug(self) -> str:
-        for v in self.variants:
-            if v.is_control:
-                break
-        return v.slug
+        return next(
+            (v.slug for v in self.variants if v.is_control), self.variants[-1].slug
+        )
 
     @property
     def filename_slug(self) -> str:
@@ -140,12 +228,12 @@ class Experiment:
         )
 
 
-@attr.s(auto_attribs=True)
+@attr.s(auto_attribs=True, slots=True)
 class NimbusBranch:
     slug: str
 
 
-@attr.s(auto_attribs=True)
+@attr.s(auto_attribs=True, slots=True)
 class NimbusExperiment:
     slug: str
     userFacingName: str
@@ -154,16 +242,14 @@ class NimbusExperiment:
     referenceBranch: Optional[str]
 
     def branches_as_variants(self) -> List[Variant]:
-        variants = []
-        for branch in self.branches:
-            variants.append(
-                Variant(
-                    slug=branch.slug,
-                    description=branch.slug,
-                    is_control=branch.slug == self.referenceBranch,
-                )
+        return [
+            Variant(
+                slug=branch.slug,
+                description=branch.slug,
+                is_control=branch.slug == self.referenceBranch,
             )
-        return variants
+            for branch in self.branches
+        ]
 
     def to_experiment_maybe(self) -> Optional[Experiment]:
         if not self.startDate:
@@ -177,13 +263,13 @@ class NimbusExperiment:
         )
 
 
-cattr.register_structure_hook(
+converter.register_structure_hook(
     datetime,
     lambda num, _: datetime.fromisoformat(num.replace("Z", "+00:00")),
 )
 
 
-@attr.s(auto_attribs=True)
+@attr.s(auto_attribs=True, slots=True)
 class ExperimentCollection:
     EXPERIMENTER_API_URL = (
         "https://experimenter.services.mozilla.com/api/v1/experiments/"
@@ -193,18 +279,44 @@ class ExperimentCollection:
         "https://experimenter.services.mozilla.com/api/v6/experiments/"
     )
 
-    experiments: Dict[str, Experiment] = {}
+    experiments: Dict[str, Experiment] = attr.Factory(dict)
 
     @classmethod
-    def from_experimenter(cls):
-        l = [
-            cattr.structure(e, Experiment)
-            for e in requests.get(cls.EXPERIMENTER_API_URL).json()
-        ] + [
-            cattr.structure(e, NimbusExperiment).to_experiment_maybe()
-            for e in requests.get(cls.EXPERIMENTER_NIMBUS_API_URL).json()
+    def from_experimenter(
+        cls, etags: Optional[Dict[str, str]] = None
+    ) -> Tuple[Optional["ExperimentCollection"], Dict[str, str]]:
+        # `etags` maps API URLs to the ETag of the response we last built from.
+        # Returns the new collection and its ETags, or None for the collection
+        # if neither endpoint has changed.
+        etags = etags or {}
+        urls = (cls.EXPERIMENTER_API_URL, cls.EXPERIMENTER_NIMBUS_API_URL)
+
+        def get(url):
+            headers = {"If-None-Match": etags[url]} if url in etags else {}
+            return session.get(url, headers=headers)
+
+        with ThreadPoolExecutor(len(urls)) as executor:
+            responses = list(executor.map(get, urls))
+        if all(r.status_code == 304 for r in responses):
+            return None, etags
+
+        # Rebuilding the collection needs both payloads, even if only one changed.
+        responses = [
+            session.get(url) if r.status_code == 304 else r
+            for url, r in zip(urls, responses)
         ]
-        return cls({x.filename_slug: x for x in l if x})
+        new_etags = {
+            url: r.headers["ETag"]
+            for url, r in zip(urls, responses)
+            if "ETag" in r.headers
+        }
+
+        legacy, nimbus = responses
+        l = [converter.structure(e, Experiment) for e in legacy.json()] + [
+            converter.structure(e, NimbusExperiment).to_experiment_maybe()
+            for e in nimbus.json()
+        ]
+        return cls({x.filename_slug: x for x in l if x}), new_etags
 
     def __getitem__(self, item: str) -> Experiment:
         return self.experiments[item]
@@ -233,7 +345,7 @@ class ResultMetric:
 
     @property
     def statistics(self) -> Iterable[ResultStatistic]:
-        for name, rows in self.data.groupby("statistic"):
+        for name, rows in contiguous_groups(self.data, "statistic"):
             yield ResultStatistic(name, rows)
 
 
@@ -242,9 +354,21 @@ class Result:
     path: str
     data: pd.DataFrame
 
+    def __attrs_post_init__(self):
+        # Sorted once so metrics and statistics can be sliced out without groupby.
+        keys = [c for c in ("metric", "statistic") if c in self.data.columns]
+        if keys:
+            self.data = self.data.sort_values(keys, kind="mergesort").reset_index(
+                drop=True
+            )
+
     @classmethod
     def from_path(cls, path) -> "Result":
-        data = pd.read_json(path)
+        raw = read_result_json(path)
+        if isinstance(raw, list):
+            data = pd.DataFrame.from_records(raw)
+        else:
+            data = pd.DataFrame(raw)
         if "comparison" not in data.columns:
             data["comparison"] = "none"
         return cls(path, data)
@@ -260,14 +384,36 @@ class Result:
 
     @property
     def metrics(self) -> Iterable[ResultMetric]:
-        for name, rows in self.data.groupby("metric"):
+        for name, rows in contiguous_groups(self.data, "metric"):
             yield ResultMetric(name, rows)
 
 
+# Result files are usually a list of records, but may be column-oriented.
+def read_result_json(path) -> Union[List[dict], Dict[str, Any]]:
+    return json.loads(Path(path).read_bytes())
+
+
+def result_column(
+    raw: Union[List[dict], Dict[str, Any]], column: str
+) -> Optional[list]:
+    # Values of `column` without building a DataFrame, or None if it is missing.
+    if isinstance(raw, list):
+        if not any(column in row for row in raw):
+            return None
+        return [row.get(column) for row in raw]
+    if column not in raw:
+        return None
+    values = raw[column]
+    return list(values.values()) if isinstance(values, dict) else list(values)
+
+
 @attr.s(auto_attribs=True)
 class ResultSet:
     slug: str
     path: Path
+    _results: Dict[str, Optional[Result]] = attr.ib(
+        factory=dict, init=False, repr=False
+    )
 
     @property
     def overall(self):
@@ -289,27 +435,40 @@ class ResultSet:
             return result.segments
         return []
 
-    def get_result(self, period: str) -> Optional[Result]:
+    def result_path(self, period: str) -> Path:
         assert period in ("daily", "weekly", "overall")
-        filename = (
+        return (
             self.path
             / f"{Cache.RESULT_CACHE_PATH}/statistics_{self.slug}_{period}.json"
         )
-        if filename.exists():
-            return Result.from_path(filename)
-        return None
+
+    def get_result(self, period: str) -> Optional[Result]:
+        if period in self._results:
+            return self._results[period]
+        filename = self.result_path(period)
+        result = Result.from_path(filename) if filename.exists() else None
+        self._results[period] = result
+        return result
+
+    def _window_index_count(self, period: str) -> Optional[int]:
+        filename = self.result_path(period)
+        if not filename.exists():
+            return None
+        values = result_column(read_result_json(filename), "window_index")
+        if values is None:
+            raise KeyError(f"{filename} has no window_index column")
+        return len(set(values) - {None})
 
     @property
     def available_code(self):
+        # Only needs file existence and window counts, so skip building DataFrames.
         try:
             available = []
-            if self.overall:
+            if self.result_path("overall").exists():
                 available.append("O")
-            if self.weekly:
-                n = len(self.weekly.data.window_index.unique())
+            if (n := self._window_index_count("weekly")) is not None:
                 available.append(f"W{n}")
-            if self.daily:
-                n = len(self.daily.data.window_index.unique())
+            if (n := self._window_index_count("daily")) is not None:
                 available.append(f"D{n}")
             return " ".join(available)
         except Exception:
@@ -317,57 +476,136 @@ class ResultSet:
 
 
 ## Helpers
-def slug_from_filename(path: Path) -> Optional[str]:
-    if not path.suffix.endswith("json"):
+def contiguous_groups(
+    data: pd.DataFrame, column: str
+) -> Iterable[Tuple[str, pd.DataFrame]]:
+    # Like data.groupby(column), for a frame that is already sorted by column.
+    values = data[column].values
+    if not len(values):
+        return
+    starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+    ends = np.r_[starts[1:], len(values)]
+    for start, end in zip(starts, ends):
+        if pd.isna(values[start]):
+            continue
+        yield values[start], data.iloc[start:end]
+
+
+def slug_from_filename(name: str) -> Optional[str]:
+    if not name.endswith(".json"):
         return None
-    return path.name.rsplit("_", 1)[0].split("_", 1)[1]
+    return name.rsplit("_", 1)[0].split("_", 1)[1]
+
+
+# Starting R and loading rmarkdown/knitr/ggplot2 costs more than rendering a typical
+# experiment, so each worker process keeps one R session around and reuses it.
+class RSession:
+    SENTINEL = "__partybal_render_done__"
+    RENDER_TIMEOUT_SECONDS = 30 * 60
+
+    lines: "queue.Queue[Optional[str]]"
+
+    def __init__(self):
+        # Avoid a Conda/Homebrew interaction
+        env = dict(os.environ)
+        env["R_LIBS_USER"] = ""
+
+        self.process = subprocess.Popen(
+            ["R", "--vanilla", "-q", "-s"],
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            encoding="utf-8",
+        )
+
+        # Read output on a separate thread so render() can give up on a stuck session.
+        self.lines = queue.Queue()
+        threading.Thread(target=self._read_output, daemon=True).start()
 
+    def _read_output(self) -> None:
+        for line in self.process.stdout:
+            self.lines.put(line)
+        self.lines.put(None)
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
 
-def render(experiment: Experiment, cache: Cache, output: Path):
+    def stop(self) -> None:
+        self.process.kill()
+        self.process.wait()
+
+    def render(self, template: Path) -> Tuple[bool, str]:
+        try:
+            self.process.stdin.write(
+                "local({ status <- tryCatch({ suppressWarnings(rmarkdown::render("
+                f"'{str(template)}', quiet=TRUE, envir=new.env())); 0 }}, "
+                "error=function(e) { message(conditionMessage(e)); 1 });"
+                f' cat("\\n{self.SENTINEL}", status, "\\n"); flush(stdout()) }})\n'
+            )
+            self.process.stdin.flush()
+        except OSError as e:
+            self.stop()
+            return False, f"Could not send render to R: {e}\n"
+
+        output: List[str] = []
+        deadline = time.monotonic() + self.RENDER_TIMEOUT_SECONDS
+        while True:
+            try:
+                line = self.lines.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                self.stop()
+                return False, "".join(output) + "R timed out\n"
+            if line is None:
+                self.stop()
+                return False, "".join(output) + "R exited unexpectedly\n"
+            if line.startswith(self.SENTINEL):
+                return line.split()[1] == "0", "".join(output)
+            output.append(line)
+
+
+_r_session: Optional[RSession] = None
+
+
+def r_session() -> RSession:
+    global _r_session
+    if _r_session is None or not _r_session.alive:
+        _r_session = RSession()
+    return _r_session
+
+
+def render(experiment: Experiment, cache: Cache, output: Path) -> bool:
     output.mkdir(exist_ok=True)
 
     slug = experiment.filename_slug
     template = output / (slug + ".Rmd")
     template.write_text(experiment.render(cache.path))
 
-    # Avoid a Conda/Homebrew interaction
-    env = dict(os.environ)
-    env["R_LIBS_USER"] = ""
-
-    result = subprocess.run(
-        [
-            "R",
-            "--vanilla",
-            "-q",
-            "-s",
-            "-e",
-            f"suppressWarnings(rmarkdown::render('{str(template)}', quiet=TRUE))",
-        ],
-        check=False,
-        env=env,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        encoding="utf-8",
-    )
+    ok, log = r_session().render(template)
 
-    if result.returncode == 0:
+    if ok:
         print(f"{slug}: ok")
     else:
         print(f"{slug}: error")
-        print(result.stdout)
+        print(log)
+    return ok
 
 
 def render_index(experiments, cache) -> str:
     to_list = {
-        slug_from_filename(p)
-        for p in cache.new_since_last_run(last_run=datetime.min.replace(tzinfo=UTC))
+        slug_from_filename(name)
+        for name in cache.new_since_last_run(last_run=datetime.min.replace(tzinfo=UTC))
     }
     to_list.discard(None)
-    results = {slug: ResultSet(slug, cache.path) for slug in to_list if slug}
     with_results = [experiments[slug] for slug in to_list if slug in experiments]
+    available_codes = {
+        e.filename_slug: ResultSet(e.filename_slug, cache.path).available_code
+        for e in with_results
+    }
     return jinja.get_template("index.html.jinja2").render(
         experiments=with_results,
-        results=results,
+        available_codes=available_codes,
     )
 
 
@@ -393,9 +631,17 @@ def invoke(output, cache, j, updated_seconds_ago):
     if updated_seconds_ago:
         last_run = datetime.now(UTC) - timedelta(seconds=updated_seconds_ago)
 
-    slugs_to_analyze = {
-        slug_from_filename(p) for p in cache.new_since_last_run(last_run)
-    }
+    hashes = None
+    if last_run is None:
+        # Syncing can touch files without changing them, so compare contents
+        # rather than mtimes against the hashes saved by the last complete run.
+        previous_hashes = cache.result_hashes
+        hashes = cache.hash_results(previous_hashes)
+        new_files = sorted(cache.changed_results(previous_hashes, hashes))
+    else:
+        new_files = cache.new_since_last_run(last_run)
+
+    slugs_to_analyze = {slug_from_filename(name) for name in new_files}
     slugs_to_analyze.discard(None)
 
     experiments = cache.experiments
@@ -403,12 +649,22 @@ def invoke(output, cache, j, updated_seconds_ago):
     output = Path(output)
     to_run = [experiments[slug] for slug in slugs_to_analyze if slug in experiments]
     map_function = partial(render, cache=cache, output=output)
-    with ThreadPoolExecutor(j or os.cpu_count()) as executor:
-        list(executor.map(map_function, to_run))
+    with ProcessPoolExecutor(j or os.cpu_count()) as executor:
+        rendered = list(executor.map(map_function, to_run))
 
     (output / "index.html").write_text(render_index(experiments, cache))
 
     cache.mark_complete()
+    if hashes is not None:
+        # Forget failed experiments' hashes so that the next run retries them.
+        failed = {e.filename_slug for e, ok in zip(to_run, rendered) if not ok}
+        cache.save_result_hashes(
+            {
+                name: h
+                for name, h in hashes.items()
+                if slug_from_filename(name) not in failed
+            }
+        )
 
 
 @cli.command()